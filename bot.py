@@ -1,11 +1,14 @@
-import json
-import sqlite3
+import asyncio
 import os
-from datetime import datetime, time
+import traceback
+from contextlib import asynccontextmanager
+from datetime import datetime, time, timedelta
+from itertools import islice
 from zoneinfo import ZoneInfo
 
+import aiosqlite
 import discord
-from discord.ext import tasks
+import ijson
 
 # =========================
 # CONFIGURACIÓN HARDCODEADA
@@ -18,23 +21,108 @@ HORA_CHANNEL_ID = 1477113428257673246      # canal donde se envía el embed de !
 
 DB_PATH = "problems.db"
 JSON_PATH = "problems.json"
+IMPORT_BATCH_SIZE = 500  # problemas por executemany al importar el JSON
 
 TZ = ZoneInfo("Atlantic/Canary")
 SEND_TIME = time(hour=21, minute=30, tzinfo=TZ)
 
+DISCORD_MAX_MESSAGE_LEN = 2000
+
 # Reacciones para el cuestionario de hora (inicio)
 HORA_REACTIONS = ["1️⃣", "2️⃣", "3️⃣"]  # 11, 12, 13
 
 # =========================
 # BASE DE DATOS
 # =========================
+SQLITE_PRAGMAS = """
+PRAGMA journal_mode = WAL;
+PRAGMA busy_timeout = 5000;
+PRAGMA synchronous = NORMAL;
+PRAGMA temp_store = MEMORY;
+PRAGMA cache_size = -64000;
+PRAGMA mmap_size = 268435456;
+"""
+
+# Sentencias de uso frecuente. Se reutiliza siempre el mismo str para que
+# la caché de sentencias preparadas de sqlite3 (cached_statements) acierte.
+SQL_GET_SKIP_OFFSET = "SELECT value FROM meta WHERE key = 'skip_offset'"
+SQL_SET_SKIP_OFFSET = "UPDATE meta SET value = ? WHERE key = 'skip_offset'"
+SQL_INSERT_PROBLEM = (
+    "INSERT OR IGNORE INTO problems(latex, source, used, added_at) VALUES (?, ?, ?, ?)"
+)
+SQL_COUNTS = "SELECT COUNT(*), COALESCE(SUM(used), 0) FROM problems"
+SQL_PROBLEM_AT_INDEX = "SELECT id, used FROM problems ORDER BY id ASC LIMIT 1 OFFSET ?"
+SQL_NEXT_UNUSED_ID = "SELECT id FROM problems WHERE used = 0 ORDER BY id ASC LIMIT 1 OFFSET ?"
+SQL_COUNT_USED_BEFORE = "SELECT COUNT(*) FROM problems WHERE used = 1 AND id < ?"
+SQL_PICK_AND_MARK_USED = """
+UPDATE problems SET used = 1
+WHERE id = (
+    SELECT id FROM problems
+    WHERE used = 0
+    ORDER BY id ASC
+    LIMIT 1 OFFSET ?
+)
+RETURNING latex, source,
+          (SELECT COUNT(*) FROM problems AS q WHERE q.used = 1 AND q.id < problems.id)
+"""
+
+_CON = None
+_DB_LOCK = asyncio.Lock()
+_last_json_mtime = 0
+
+# Contadores en memoria (None = sin cargar). Solo este proceso escribe en la
+# base de datos, así que basta con actualizarlos tras cada escritura.
+_total = None
+_used = None
+
+async def open_db():
+    """
+    Abre la conexión compartida del proceso (aiosqlite: las consultas corren
+    en un hilo aparte y no bloquean el event loop). Va en modo autocommit
+    (isolation_level=None): las lecturas van sueltas y todas las escrituras
+    pasan por transaction().
+    """
+    global _CON
+    if _CON is None:
+        con = await aiosqlite.connect(DB_PATH, isolation_level=None, cached_statements=256)
+        await con.executescript(SQLITE_PRAGMAS)
+        _CON = con
+    return _CON
+
+async def close_db():
+    global _CON, _total, _used
+    if _CON is not None:
+        await _CON.close()
+        _CON = None
+    _total = _used = None
+
 def db():
-    return sqlite3.connect(DB_PATH)
+    if _CON is None:
+        raise RuntimeError("La base de datos no está abierta (falta open_db()).")
+    return _CON
+
+@asynccontextmanager
+async def transaction():
+    """
+    Ejecuta el bloque dentro de una transacción de escritura de la conexión
+    compartida. BEGIN IMMEDIATE toma el bloqueo de escritura al empezar, así
+    dos escritores no se quedan atascados subiendo de SHARED a RESERVED.
+    _DB_LOCK evita que otra corrutina cuele sentencias en mitad de ella.
+    """
+    con = db()
+    async with _DB_LOCK:
+        await con.execute("BEGIN IMMEDIATE")
+        try:
+            yield con
+        except BaseException:
+            await con.rollback()
+            raise
+        await con.commit()
 
-def init_db():
+async def init_db():
     """Crea la tabla (con source y skip_offset) si no existe."""
-    with db() as con:
-        con.execute(
+    async with transaction() as con:
+        await con.execute(
             """
             CREATE TABLE IF NOT EXISTS problems (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -45,7 +133,7 @@ def init_db():
             )
             """
         )
-        con.execute(
+        await con.execute(
             """
             CREATE TABLE IF NOT EXISTS meta (
                 key TEXT PRIMARY KEY,
@@ -53,134 +141,194 @@ def init_db():
             )
             """
         )
-        cur = con.execute("SELECT value FROM meta WHERE key = 'skip_offset'")
-        row = cur.fetchone()
-        if row is None:
-            con.execute("INSERT INTO meta(key, value) VALUES('skip_offset', 0)")
-        con.commit()
-
-def get_skip_offset() -> int:
-    with db() as con:
-        cur = con.execute("SELECT value FROM meta WHERE key = 'skip_offset'")
-        row = cur.fetchone()
-        return int(row[0]) if row else 0
-
-def set_skip_offset(value: int):
-    with db() as con:
-        con.execute(
-            "UPDATE meta SET value = ? WHERE key = 'skip_offset'",
-            (int(value),),
+        await con.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ux_problems_latex_source "
+            "ON problems(latex, source)"
+        )
+        await con.execute(
+            "CREATE INDEX IF NOT EXISTS ix_problems_unused ON problems(id) WHERE used = 0"
+        )
+        await con.execute(
+            "CREATE INDEX IF NOT EXISTS ix_problems_used ON problems(id) WHERE used = 1"
         )
-        con.commit()
+        async with con.execute(SQL_GET_SKIP_OFFSET) as cur:
+            row = await cur.fetchone()
+        if row is None:
+            await con.execute("INSERT INTO meta(key, value) VALUES('skip_offset', 0)")
+
+async def get_skip_offset() -> int:
+    async with db().execute(SQL_GET_SKIP_OFFSET) as cur:
+        row = await cur.fetchone()
+    return int(row[0]) if row else 0
+
+async def set_skip_offset(value: int):
+    async with transaction() as con:
+        await con.execute(SQL_SET_SKIP_OFFSET, (int(value),))
 
-def import_json(json_path: str):
+def _next_rows(items, now_iso: str):
+    """Consume hasta IMPORT_BATCH_SIZE problemas del iterador de ijson."""
+    return [
+        (str(it["latex"]).strip(), str(it.get("source", "")).strip(), 0, now_iso)
+        for it in islice(items, IMPORT_BATCH_SIZE)
+    ]
+
+async def import_json(json_path: str):
     """
     Añade a la base de datos TODOS los problemas del JSON que aún no estén
     (mismo latex+source), manteniendo el orden por added_at.
     Si el JSON está vacío o no existe, no añade nada.
+    El fichero se lee en streaming (ijson) por lotes de IMPORT_BATCH_SIZE;
+    el parseo de cada lote corre en un hilo para no bloquear el event loop.
     """
+    global _total
     if not os.path.exists(json_path):
         print(f"No se encontró {json_path}")
         return
 
-    with open(json_path, "r", encoding="utf-8") as f:
+    # Todas las filas de una misma importación comparten timestamp; el índice
+    # único (latex, source) descarta los duplicados dentro del propio motor.
+    now_iso = datetime.now(tz=TZ).isoformat()
+    seen = 0
+
+    with open(json_path, "rb") as f:
+        items = ijson.items(f, "item")
         try:
-            items = json.load(f)
-        except json.JSONDecodeError as e:
+            async with transaction() as con:
+                before = con.total_changes
+                while True:
+                    rows = await asyncio.to_thread(_next_rows, items, now_iso)
+                    if not rows:
+                        break
+                    seen += len(rows)
+                    await con.executemany(SQL_INSERT_PROBLEM, rows)
+                added = con.total_changes - before
+        except ijson.JSONError as e:
             print(f"Error al leer {json_path}: {e}")
             return
 
-    if not items:
+    if _total is not None:
+        _total += added
+
+    if not seen:
         print("problems.json está vacío, no se añaden problemas.")
         return
 
-    added = 0
-    with db() as con:
-        for it in items:
-            latex = str(it["latex"]).strip()
-            source = str(it.get("source", "")).strip()
-            added_at = datetime.now(tz=TZ).isoformat()
-
-            cur = con.execute(
-                "SELECT COUNT(*) FROM problems WHERE latex = ? AND source = ?",
-                (latex, source),
-            )
-            exists = cur.fetchone()[0]
-            if exists:
-                continue
-
-            con.execute(
-                "INSERT INTO problems(latex, source, used, added_at) VALUES (?, ?, 0, ?)",
-                (latex, source, added_at),
-            )
-            added += 1
-        con.commit()
-
     print(f"Importados {added} problemas nuevos desde {json_path}")
 
-def total_problems_count():
-    with db() as con:
-        cur = con.execute("SELECT COUNT(*) FROM problems")
-        return cur.fetchone()[0]
+async def import_json_if_changed(json_path: str):
+    """
+    Llama a import_json solo si el fichero ha cambiado (st_mtime_ns) desde la
+    última importación hecha por este proceso.
+    """
+    global _last_json_mtime
+    try:
+        mtime = os.stat(json_path).st_mtime_ns
+    except FileNotFoundError:
+        print(f"No se encontró {json_path}")
+        return
 
-def used_problems_count():
-    with db() as con:
-        cur = con.execute("SELECT COUNT(*) FROM problems WHERE used = 1")
-        return cur.fetchone()[0]
+    if mtime == _last_json_mtime:
+        return
 
-def remaining_problems_count():
-    with db() as con:
-        cur = con.execute("SELECT COUNT(*) FROM problems WHERE used = 0")
-        return cur.fetchone()[0]
+    await import_json(json_path)
+    _last_json_mtime = mtime
 
-def get_problem_by_index(idx: int):
+async def _load_counts():
     """
-    Devuelve el problema por índice lógico 1-based (ordenado por id ASC),
-    sin tocar 'used'.
+    Carga _total y _used con una sola consulta si aún no están en memoria.
+    Se hace bajo _DB_LOCK para que ninguna escritura se cuele entre la
+    lectura y la asignación.
     """
-    if idx <= 0:
-        return None
+    global _total, _used
+    if _total is not None and _used is not None:
+        return
+    async with _DB_LOCK:
+        if _total is None or _used is None:
+            async with db().execute(SQL_COUNTS) as cur:
+                _total, _used = await cur.fetchone()
 
-    with db() as con:
-        row = con.execute(
-            "SELECT id, latex, source FROM problems ORDER BY id ASC LIMIT 1 OFFSET ?",
-            (idx - 1,),
-        ).fetchone()
+async def total_problems_count():
+    await _load_counts()
+    return _total
 
-        if row is None:
-            return None
+async def used_problems_count():
+    await _load_counts()
+    return _used
 
-        pid, latex, source = row
-        return pid, latex, source
+async def remaining_problems_count():
+    await _load_counts()
+    return _total - _used
 
-def mark_used(pid: int):
-    with db() as con:
-        con.execute("UPDATE problems SET used = 1 WHERE id = ?", (pid,))
-        con.commit()
+async def counts():
+    """Devuelve (total, usados, restantes), desde los contadores en memoria."""
+    await _load_counts()
+    return _total, _used, _total - _used
 
-def pick_next_with_skip():
+async def set_skip_to_problem(n: int):
     """
-    Escoge el problema del día teniendo en cuenta:
-      - cuántos ya se han usado (usados),
-      - el offset global de skip (skip_offset).
-    Índice lógico = usados + 1 + skip_offset.
-    Marca used = 1 para ese problema.
+    Configura skip_offset para que el próximo pick sea el problema #n
+    (posición 1-based entre todos los problemas, por id ASC): skip_offset es
+    el número de problemas sin usar con id menor que el suyo.
+    Devuelve el nuevo skip_offset, o None si #n no existe o ya se envió.
     """
-    usados = used_problems_count()
-    skip = get_skip_offset()
-    total = total_problems_count()
+    async with transaction() as con:
+        async with con.execute(SQL_PROBLEM_AT_INDEX, (n - 1,)) as cur:
+            row = await cur.fetchone()
+        if row is None or row[1]:
+            return None
+
+        pid = row[0]
+        async with con.execute(SQL_COUNT_USED_BEFORE, (pid,)) as cur:
+            usados_antes = (await cur.fetchone())[0]
+
+        skip = (n - 1) - usados_antes
+        await con.execute(SQL_SET_SKIP_OFFSET, (skip,))
+    return skip
 
-    logical_index = usados + 1 + skip
-    if logical_index > total:
+async def next_problem_index():
+    """
+    Posición 1-based (numeración de !skip) del problema que escogería ahora
+    pick_next_with_skip, o None si no queda ninguno con el skip actual.
+    Es el (skip_offset + 1)-ésimo sin usar, así que su posición es
+    skip_offset + 1 + los usados con id menor.
+    """
+    skip = await get_skip_offset()
+    async with db().execute(SQL_NEXT_UNUSED_ID, (skip,)) as cur:
+        row = await cur.fetchone()
+    if row is None:
         return None
 
-    result = get_problem_by_index(logical_index)
-    if result is None:
+    async with db().execute(SQL_COUNT_USED_BEFORE, (row[0],)) as cur:
+        usados_antes = (await cur.fetchone())[0]
+    return skip + 1 + usados_antes
+
+async def pick_next_with_skip():
+    """
+    Escoge el problema del día: el primero sin usar (por id ASC) tras saltarse
+    skip_offset problemas sin usar. El índice lógico que se devuelve es su
+    posición 1-based entre todos los problemas, la misma numeración de !skip.
+    Lo marca como used = 1 en la misma sentencia (UPDATE ... RETURNING),
+    dentro de la misma transacción en la que se lee skip_offset.
+    La posición es skip_offset + 1 + los usados con id menor (ver
+    next_problem_index): el recuento recorre solo ix_problems_used, es decir,
+    crece con los problemas ya enviados y no con el tamaño de la tabla.
+    """
+    global _used
+    async with transaction() as con:
+        async with con.execute(SQL_GET_SKIP_OFFSET) as cur:
+            row = await cur.fetchone()
+        skip = int(row[0]) if row else 0
+
+        async with con.execute(SQL_PICK_AND_MARK_USED, (skip,)) as cur:
+            row = await cur.fetchone()
+    if row is None:
         return None
 
-    pid, latex, source = result
-    mark_used(pid)
-    return logical_index, latex, source
+    if _used is not None:
+        _used += 1
+
+    latex, source, usados_antes = row
+    return skip + 1 + usados_antes, latex, source
 
 # =========================
 # BOT
@@ -197,8 +345,63 @@ class Bot(discord.Client):
         self.hora_poll_message_id = None
         self.hora_poll_channel_id = HORA_CHANNEL_ID
 
+        self._daily_task = None
+
+        # Serializa la comprobación de contadores + elección del problema del día
+        self.pick_lock = asyncio.Lock()
+
+        # Canales ya resueltos (ver cached_channel)
+        self._info_channel = None
+        self._problem_channel = None
+        self._hora_channel = None
+
     async def setup_hook(self):
-        daily_problem.start()
+        await open_db()
+        await init_db()
+        await import_json_if_changed(JSON_PATH)
+        self._daily_task = asyncio.create_task(self._daily_runner())
+
+    async def cached_channel(self, channel_id: int, attr: str):
+        """
+        Devuelve el canal guardado en self.<attr>; la primera vez lo resuelve
+        con get_channel (o fetch_channel si no está en caché) y lo guarda.
+        """
+        channel = getattr(self, attr)
+        if channel is None:
+            channel = self.get_channel(channel_id)
+            if channel is None:
+                channel = await self.fetch_channel(channel_id)
+            setattr(self, attr, channel)
+        return channel
+
+    async def _daily_runner(self):
+        """
+        Duerme hasta la próxima SEND_TIME (hora de Canarias) y lanza
+        daily_problem; un fallo se registra sin detener el bucle.
+        """
+        await self.wait_until_ready()
+        while not self.is_closed():
+            now = datetime.now(tz=TZ)
+            target = datetime.combine(now.date(), SEND_TIME)
+            if target <= now:
+                target = datetime.combine(now.date() + timedelta(days=1), SEND_TIME)
+
+            # Se compara con timestamps (no restando datetimes con la misma
+            # zona) para que la espera sea correcta aunque cambie el horario
+            # de verano; el bucle cubre despertares un poco adelantados.
+            while (delay := target.timestamp() - datetime.now(tz=TZ).timestamp()) > 0:
+                await asyncio.sleep(delay)
+
+            try:
+                await daily_problem()
+            except Exception:
+                traceback.print_exc()
+
+    async def close(self):
+        if self._daily_task is not None:
+            self._daily_task.cancel()
+        await super().close()
+        await close_db()
 
 bot = Bot()
 
@@ -210,22 +413,19 @@ async def on_ready():
     print(f"Canal de !hora: {HORA_CHANNEL_ID}")
     print(f"Hora diaria (Canarias): {SEND_TIME}")
 
-    info_channel = bot.get_channel(INFO_CHANNEL_ID)
-    if info_channel is None:
-        info_channel = await bot.fetch_channel(INFO_CHANNEL_ID)
+    info_channel = await bot.cached_channel(INFO_CHANNEL_ID, "_info_channel")
 
-    total = total_problems_count()
-    usados = used_problems_count()
-    restantes = remaining_problems_count()
-    skip = get_skip_offset()
-    numero_siguiente_logico = usados + 1 + skip
+    total, usados, restantes = await counts()
+    skip = await get_skip_offset()
+    siguiente = await next_problem_index()
+    numero_siguiente_logico = f"#{siguiente}" if siguiente is not None else "ninguno"
 
     mensaje_info = (
         f"📊 Problemas en la base de datos: {total}\n"
         f"✅ Ya enviados (marcados como usados): {usados}\n"
         f"🕒 Pendientes (unused): {restantes}\n"
         f"⏭ Offset de skip actual: {skip}\n"
-        f"➡️ Próximo problema lógico (con skip): #{numero_siguiente_logico}"
+        f"➡️ Próximo problema lógico (con skip): {numero_siguiente_logico}"
     )
 
     await info_channel.send(mensaje_info)
@@ -234,9 +434,7 @@ async def send_hora_poll(trigger_channel: discord.abc.Messageable, author: disco
     """
     Envía un embed con encuesta al canal HORA_CHANNEL_ID y añade 3 reacciones.
     """
-    channel = bot.get_channel(HORA_CHANNEL_ID)
-    if channel is None:
-        channel = await bot.fetch_channel(HORA_CHANNEL_ID)
+    channel = await bot.cached_channel(HORA_CHANNEL_ID, "_hora_channel")
 
     embed = discord.Embed(
         title="🗓️ Próxima reunión: elige hora de inicio",
@@ -266,18 +464,27 @@ async def send_hora_poll(trigger_channel: discord.abc.Messageable, author: disco
 
 @bot.event
 async def on_message(message: discord.Message):
+    # Todos los comandos empiezan por "!": el resto de mensajes se descartan
+    # antes de mirar el autor o hacer cualquier otra cosa.
+    content = message.content
+    if not content or content[0] != "!":
+        return
+
     if message.author == bot.user:
         return
 
-    # Comando: !skip <n>
-    if message.content.startswith("!skip"):
-        parts = message.content.split()
-        if len(parts) != 2 or not parts[1].isdigit():
+    # Comando: !skip <n> (no vale "!skipxyz")
+    if content[:5] == "!skip" and (len(content) == 5 or content[5].isspace()):
+        parts = content.split()
+        try:
+            n = int(parts[1]) if len(parts) == 2 else None
+        except ValueError:
+            n = None
+        if n is None:
             await message.channel.send("Uso: `!skip <número_de_problema_que_quieres_para_hoy>`")
             return
 
-        n = int(parts[1])
-        total = total_problems_count()
+        total = await total_problems_count()
         if total == 0:
             await message.channel.send("No hay problemas en la base de datos.")
             return
@@ -286,16 +493,14 @@ async def on_message(message: discord.Message):
             await message.channel.send(f"El número debe estar entre 1 y {total}.")
             return
 
-        usados = used_problems_count()
-        nuevo_skip = n - (usados + 1)
-        if nuevo_skip < 0:
+        usados = await used_problems_count()
+        nuevo_skip = await set_skip_to_problem(n)
+        if nuevo_skip is None:
             await message.channel.send(
-                f"El problema #{n} ya está por detrás del progreso actual (usados = {usados})."
+                f"El problema #{n} ya se envió (usados = {usados})."
             )
             return
 
-        set_skip_offset(nuevo_skip)
-
         await message.channel.send(
             f"✅ Hoy se configuró para enviar el problema #{n}.\n"
             f"(usados = {usados}, skip_offset = {nuevo_skip})"
@@ -303,7 +508,7 @@ async def on_message(message: discord.Message):
         return
 
     # Comando: !hora
-    if message.content.strip() == "!hora":
+    if content.strip() == "!hora":
         await send_hora_poll(message.channel, message.author)
         return
 
@@ -346,25 +551,25 @@ async def on_reaction_add(reaction: discord.Reaction, user: discord.User):
     except discord.HTTPException:
         pass
 
-@tasks.loop(time=SEND_TIME)
 async def daily_problem():
-    problem_channel = bot.get_channel(PROBLEM_CHANNEL_ID)
-    if problem_channel is None:
-        problem_channel = await bot.fetch_channel(PROBLEM_CHANNEL_ID)
+    problem_channel = await bot.cached_channel(PROBLEM_CHANNEL_ID, "_problem_channel")
 
-    import_json(JSON_PATH)
+    await import_json_if_changed(JSON_PATH)
 
-    total = total_problems_count()
-    if total == 0:
-        await problem_channel.send("❌ No hay problemas en la base de datos.")
-        return
+    # pick_next_with_skip ya es atómico (transaction()); el lock cubre además
+    # la comprobación de contadores previa, para que dos disparos seguidos no
+    # decidan con los mismos contadores.
+    async with bot.pick_lock:
+        total, _, restantes = await counts()
+        if total == 0:
+            await problem_channel.send("❌ No hay problemas en la base de datos.")
+            return
 
-    restantes = remaining_problems_count()
-    if restantes == 0:
-        await problem_channel.send("❌ Faltan problemas en la base de datos (todos usados).")
-        return
+        if restantes == 0:
+            await problem_channel.send("❌ Faltan problemas en la base de datos (todos usados).")
+            return
 
-    picked = pick_next_with_skip()
+        picked = await pick_next_with_skip()
     if picked is None:
         await problem_channel.send("❌ No hay problema disponible con el skip actual.")
         return
@@ -380,15 +585,18 @@ async def daily_problem():
     encabezado = f"📌 Problema #{logical_index}"
     print("VOY A ENVIAR:", repr(encabezado), repr(mensaje), repr(fuente_msg))
 
-    await problem_channel.send(encabezado)
-    await problem_channel.send(mensaje)
-    await problem_channel.send(fuente_msg)
+    # Un solo mensaje (una sola petición HTTP) salvo que supere el límite de
+    # Discord; en ese caso se manda por partes como antes.
+    completo = f"{encabezado}\n{mensaje}\n{fuente_msg}"
+    if len(completo) <= DISCORD_MAX_MESSAGE_LEN:
+        await problem_channel.send(completo)
+    else:
+        await problem_channel.send(encabezado)
+        await problem_channel.send(mensaje)
+        await problem_channel.send(fuente_msg)
 
 if __name__ == "__main__":
     if not TOKEN:
         raise RuntimeError("TOKEN está vacío.")
 
-    init_db()
-    import_json(JSON_PATH)
-
     bot.run(TOKEN)